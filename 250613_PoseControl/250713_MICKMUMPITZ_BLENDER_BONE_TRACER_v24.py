@@ -1,7 +1,7 @@
 bl_info = {
     "name": "Bone Tracer for ComfyUI",
     "author": "Claude Assistant",
-    "version": (1, 0, 0),
+    "version": (1, 1, 0),
     "blender": (3, 0, 0),
     "location": "View3D > Sidebar > Bone Tracer",
     "description": "Export selected bones and empty objects as pixel coordinates for ComfyUI",
@@ -12,11 +12,24 @@ import bpy
 import bmesh
 import json
 import os
-from mathutils import Vector
-from bpy_extras.object_utils import world_to_camera_view
+import numpy as np
+from mathutils import Matrix, Vector
+from bpy.app.handlers import persistent
 from bpy.props import StringProperty, IntProperty, BoolProperty, EnumProperty
 from bpy.types import Panel, Operator, PropertyGroup
 
+# orjson is not bundled with Blender, fall back to the standard library when missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Numba is optional as well, the NumPy projection is used when it is missing
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = prange = None
+
 class BoneTracerProperties(PropertyGroup):
     output_path: StringProperty(
         name="Output Path",
@@ -75,6 +88,236 @@ class BoneTracerProperties(PropertyGroup):
         description="Use the scene's frame range instead of custom values",
         default=True
     )
+    
+    output_format: EnumProperty(
+        name="Output Format",
+        description="How each traced point is written to the file",
+        items=[
+            ('POINTS', 'Points', 'Write points as {"x": x, "y": y}, as read by ComfyUI path nodes'),
+            ('PAIRS', 'Pairs', 'Write points as compact [x, y] pairs, less than half the file size'),
+        ],
+        default='POINTS'
+    )
+
+IDENTITY_MATRIX = Matrix.Identity(4)
+
+# Modifiers that simulate over time, toggling anything near them would reset their caches
+SIMULATION_MODIFIERS = {'CLOTH', 'COLLISION', 'DYNAMIC_PAINT', 'FLUID', 'PARTICLE_SYSTEM', 'SOFT_BODY'}
+
+def is_animated(obj):
+    """Return True if obj or one of its parents is animated, driven or constrained"""
+    while obj is not None:
+        for id_data in (obj, obj.data):
+            animation_data = getattr(id_data, 'animation_data', None)
+            if animation_data and (animation_data.action or animation_data.drivers or animation_data.nla_tracks):
+                return True
+        
+        # Constraint targets may move, so any constraint counts
+        if obj.constraints:
+            return True
+        if obj.type == 'ARMATURE' and any(bone.constraints for bone in obj.pose.bones):
+            return True
+        
+        # Simulated or following deforming geometry, neither shows up as animation data
+        if obj.rigid_body or obj.parent_type in {'VERTEX', 'VERTEX_3'}:
+            return True
+        
+        obj = obj.parent
+    
+    return False
+
+def referenced_objects(struct):
+    """Yield every object a modifier, constraint, node or data block points at through its RNA pointers"""
+    for prop in struct.bl_rna.properties:
+        if prop.type != 'POINTER':
+            continue
+        value = getattr(struct, prop.identifier, None)
+        if isinstance(value, bpy.types.Object):
+            yield value
+        elif isinstance(value, bpy.types.Collection):
+            yield from value.all_objects
+
+def node_tree_objects(node_tree, visited):
+    """Yield every object referenced by a node tree's nodes and socket values, including nested groups"""
+    if node_tree is None or node_tree in visited:
+        return
+    visited.add(node_tree)
+    
+    for node in node_tree.nodes:
+        yield from referenced_objects(node)
+        for socket in node.inputs:
+            value = getattr(socket, 'default_value', None)
+            if isinstance(value, bpy.types.Object):
+                yield value
+            elif isinstance(value, bpy.types.Collection):
+                yield from value.all_objects
+        if node.type == 'GROUP':
+            yield from node_tree_objects(node.node_tree, visited)
+
+def driver_objects(id_data):
+    """Yield every object read by a driver variable on the given ID"""
+    animation_data = getattr(id_data, 'animation_data', None)
+    if not animation_data:
+        return
+    
+    for fcurve in animation_data.drivers:
+        for variable in fcurve.driver.variables:
+            for target in variable.targets:
+                if isinstance(target.id, bpy.types.Object):
+                    yield target.id
+
+def collect_dependencies(objects):
+    """Return the given objects plus every object their transforms or geometry can depend on"""
+    needed = set()
+    pending = list(objects)
+    
+    while pending:
+        obj = pending.pop()
+        if obj is None or obj in needed:
+            continue
+        needed.add(obj)
+        pending.append(obj.parent)
+        
+        constraints = list(obj.constraints)
+        if obj.type == 'ARMATURE':
+            for bone in obj.pose.bones:
+                constraints.extend(bone.constraints)
+        
+        for constraint in constraints:
+            pending.extend(referenced_objects(constraint))
+            # Armature constraints list their targets separately
+            for target in getattr(constraint, 'targets', ()):
+                pending.append(target.target)
+        
+        # Modifiers may read other objects' geometry, e.g. Shrinkwrap targets or Object Info nodes
+        for modifier in obj.modifiers:
+            pending.extend(referenced_objects(modifier))
+            if modifier.type == 'NODES':
+                # Geometry nodes inputs are stored as ID properties on the modifier
+                for key in modifier.keys():
+                    value = modifier[key]
+                    if isinstance(value, bpy.types.Object):
+                        pending.append(value)
+                    elif isinstance(value, bpy.types.Collection):
+                        pending.extend(value.all_objects)
+                pending.extend(node_tree_objects(modifier.node_group, set()))
+        
+        # Object data can point at objects too, e.g. curve bevel and taper objects
+        if obj.data is not None:
+            pending.extend(referenced_objects(obj.data))
+        
+        for id_data in (obj, obj.data, getattr(obj.data, 'shape_keys', None)):
+            pending.extend(driver_objects(id_data))
+    
+    return needed
+
+def mute_unneeded_modifiers(scene, view_layer, needed, muted_modifiers):
+    """Hide viewport modifiers on objects the traces don't depend on, recording each one in muted_modifiers"""
+    # Leave simulations alone, they are stepped by frame_set and read other objects' geometry.
+    # Rigid bodies are object settings rather than modifiers, and collide through evaluated meshes
+    # no dependency walk can follow, so any rigid body world rules muting out as well
+    if any(modifier.type in SIMULATION_MODIFIERS for obj in view_layer.objects for modifier in obj.modifiers):
+        return
+    if scene.rigidbody_world or any(obj.rigid_body or obj.rigid_body_constraint for obj in view_layer.objects):
+        return
+    
+    for obj in view_layer.objects:
+        if obj in needed:
+            continue
+        # Geometry nodes may hold simulation zones, which are reset the same way
+        if any(modifier.type == 'NODES' for modifier in obj.modifiers):
+            continue
+        for modifier in obj.modifiers:
+            if modifier.show_viewport:
+                modifier.show_viewport = False
+                muted_modifiers.append(modifier)
+
+def compile_kernel(func, **options):
+    """JIT compile func with Numba, caching the machine code next to the script when possible"""
+    try:
+        return njit(cache=True, **options)(func)
+    except RuntimeError:
+        # Scripts run from Blender's text editor have no file to cache next to
+        return njit(**options)(func)
+
+def project_batch(world, M, res_x, res_y, out):
+    """Project one frame's (N, 3) world positions into (N, 2) int32 pixel coordinates"""
+    for i in range(world.shape[0]):
+        x = M[0, 0] * world[i, 0] + M[0, 1] * world[i, 1] + M[0, 2] * world[i, 2] + M[0, 3]
+        y = M[1, 0] * world[i, 0] + M[1, 1] * world[i, 1] + M[1, 2] * world[i, 2] + M[1, 3]
+        w = M[3, 0] * world[i, 0] + M[3, 1] * world[i, 1] + M[3, 2] * world[i, 2] + M[3, 3]
+        
+        # Perspective divide, points on the camera plane land in the frame center
+        if w != 0.0:
+            nx = x / w
+            ny = y / w
+        else:
+            nx = 0.0
+            ny = 0.0
+        
+        out[i, 0] = int((nx * 0.5 + 0.5) * res_x)
+        out[i, 1] = int((1.0 - (ny * 0.5 + 0.5)) * res_y)
+
+def project_all(world_all, cam_projs, res_x, res_y, out):
+    """Compiled counterpart of project_to_pixels, frames are projected in parallel without the GIL"""
+    for f in prange(world_all.shape[0]):
+        project_batch(world_all[f], cam_projs[f], res_x, res_y, out[f])
+
+if njit is not None:
+    project_batch = compile_kernel(project_batch, fastmath=True, nogil=True)
+    project_all = compile_kernel(project_all, parallel=True, nogil=True)
+else:
+    project_batch = project_all = None
+
+def project_to_pixels(world_all, cam_projs, res_x, res_y, out):
+    """Project (F, N, 3) world positions into (F, N, 2) int32 pixel coordinates with top-left origin"""
+    if project_all is not None:
+        project_all(world_all, cam_projs, res_x, res_y, out)
+        return
+    
+    # Homogeneous clip space for every frame in one batched matrix multiply
+    ones = np.ones(world_all.shape[:-1] + (1,))
+    clip = np.concatenate((world_all, ones), axis=-1) @ cam_projs.transpose(0, 2, 1)
+    w = clip[..., 3:4]
+    
+    # Perspective divide, points on the camera plane land in the frame center
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndc = np.where(w != 0.0, clip[..., :2] / w, 0.0)
+    
+    out[..., 0] = (ndc[..., 0] * 0.5 + 0.5) * res_x
+    out[..., 1] = (1.0 - (ndc[..., 1] * 0.5 + 0.5)) * res_y
+
+# Multi-MB exports of long animations are written through a 1 MiB buffer
+WRITE_BUFFER_SIZE = 1 << 20
+
+# One {"x", "y"} point laid out exactly as json.dumps(indent=2) writes it inside a trace
+POINT_TEMPLATE = '    {\n      "x": %d,\n      "y": %d\n    }'
+
+def encode_points(bone_traces):
+    """Encode [x, y] traces as indented {"x", "y"} point JSON without building a dict per point"""
+    if not bone_traces:
+        return b'[]'
+    
+    encoded_traces = []
+    for trace in bone_traces:
+        if trace:
+            encoded_traces.append('  [\n' + ',\n'.join([POINT_TEMPLATE % (x, y) for x, y in trace]) + '\n  ]')
+        else:
+            encoded_traces.append('  []')
+    
+    return ('[\n' + ',\n'.join(encoded_traces) + '\n]').encode('utf-8')
+
+def encode_traces(bone_traces, output_format):
+    """Encode [x, y] traces as indented JSON bytes in the given output format, using orjson when it is installed"""
+    if orjson is not None:
+        if output_format == 'POINTS':
+            bone_traces = [[{"x": x, "y": y} for x, y in trace] for trace in bone_traces]
+        return orjson.dumps(bone_traces, option=orjson.OPT_INDENT_2)
+    
+    # The standard library only has a C encoder for unindented output, so points use the template
+    if output_format == 'POINTS':
+        return encode_points(bone_traces)
+    return json.dumps(bone_traces, indent=2).encode('utf-8')
 
 class BONE_TRACER_OT_export(Operator):
     """Export selected bones and empty objects to text file for ComfyUI"""
@@ -118,16 +361,8 @@ class BONE_TRACER_OT_export(Operator):
             self.report({'ERROR'}, "No armature or empty objects selected. Please select armature and/or empty objects.")
             return {'CANCELLED'}
         
-        # Switch to pose mode to get bone transforms
-        original_mode = context.mode
-        original_active = context.active_object
-        
+        # Bone selection is stored on the armature data, no need to enter pose mode
         for armature in selected_armatures:
-            # Make this armature active and switch to pose mode
-            context.view_layer.objects.active = armature
-            if context.mode != 'POSE':
-                bpy.ops.object.mode_set(mode='POSE')
-            
             # Get selected pose bones from this armature
             for bone in armature.pose.bones:
                 if bone.bone.select:
@@ -137,82 +372,117 @@ class BONE_TRACER_OT_export(Operator):
             self.report({'ERROR'}, "No bones selected and no empty objects selected. Please select bones in pose mode on armatures or select empty objects.")
             return {'CANCELLED'}
         
+        # Group bone names by armature so each armature's matrix is fetched once per frame,
+        # bones are looked up on the evaluated armature by name
+        bones_by_armature = {}
+        for bone, armature in selected_bones_with_armature:
+            bones_by_armature.setdefault(armature, []).append(bone.name)
+        
         # Store current frame
         current_frame = context.scene.frame_current
         
-        # Trace each bone over time
-        bone_traces = []
+        # Trace each bone over time, one trace per bone followed by one per empty
+        num_traces = len(selected_bones_with_armature) + len(selected_empties)
+        num_frames = max(0, frame_end - frame_start + 1)
+        coords = np.empty((num_frames, num_traces, 2), dtype=np.int32)
+        world_positions = np.empty((num_frames, num_traces, 3))
+        cam_projs = np.empty((num_frames, 4, 4))
+        
+        # Camera frame is always fitted to the scene render aspect, like world_to_camera_view
+        render = context.scene.render
+        camera_animated = is_animated(camera)
+        
+        # Static scenes give the same result on every frame, so only the first one is evaluated
+        scene_animated = camera_animated or any(is_animated(obj) for obj in selected_armatures + selected_empties)
+        num_sampled_frames = num_frames if scene_animated else min(num_frames, 1)
+        
+        # Only transforms are sampled, so skip evaluating modifiers on everything else
+        needed = collect_dependencies(selected_armatures + selected_empties + [camera])
+        muted_modifiers = []
         
+        # Scene evaluation is not thread safe, so positions are gathered frame by frame
+        # and only the projection below runs in parallel
         try:
-            # Process bones from armatures
-            for bone, armature in selected_bones_with_armature:
-                bone_trace = []
+            # Muted inside the try so a failure part-way still restores what was hidden
+            mute_unneeded_modifiers(context.scene, context.view_layer, needed, muted_modifiers)
+            
+            # Go through each frame once and sample every traced object on it
+            for f, frame in enumerate(range(frame_start, frame_start + num_sampled_frames)):
+                context.scene.frame_set(frame)
                 
-                # Go through each frame
-                for frame in range(frame_start, frame_end + 1):
-                    context.scene.frame_set(frame)
-                    
-                    # Get bone position based on selected point
-                    if props.bone_point == 'HEAD':
-                        bone_pos = bone.head
-                    elif props.bone_point == 'TAIL':
-                        bone_pos = bone.tail
-                    else:  # CENTER
-                        bone_pos = (bone.head + bone.tail) / 2
-                    
-                    # Convert to world space using this armature's matrix
-                    world_pos = armature.matrix_world @ bone_pos
-                    
-                    # Convert to camera space (0-1 normalized)
-                    cam_pos = world_to_camera_view(context.scene, camera, world_pos)
-                    
-                    # Convert to pixel coordinates with top-left origin (0,0)
-                    pixel_pos = {
-                        "x": int(cam_pos.x * res_x),
-                        "y": int((1.0 - cam_pos.y) * res_y)
-                    }
-                    
-                    bone_trace.append(pixel_pos)
+                # All transforms on this frame are read from one evaluated snapshot
+                depsgraph = context.evaluated_depsgraph_get()
                 
-                bone_traces.append(bone_trace)
-            
-            # Process empty objects
-            for empty in selected_empties:
-                empty_trace = []
+                # Combined world to clip space matrix, rebuilt only while the camera moves
+                if f == 0 or camera_animated:
+                    camera_eval = camera.evaluated_get(depsgraph)
+                    cam_proj = np.array(camera_eval.calc_matrix_camera(
+                        depsgraph,
+                        x=render.resolution_x,
+                        y=render.resolution_y,
+                        scale_x=render.pixel_aspect_x,
+                        scale_y=render.pixel_aspect_y,
+                    ) @ camera_eval.matrix_world.normalized().inverted())
+                cam_projs[f] = cam_proj
                 
-                # Go through each frame
-                for frame in range(frame_start, frame_end + 1):
-                    context.scene.frame_set(frame)
-                    
-                    # Get empty object's world position
-                    world_pos = empty.matrix_world.translation
-                    
-                    # Convert to camera space (0-1 normalized)
-                    cam_pos = world_to_camera_view(context.scene, camera, world_pos)
+                # Process bones from armatures
+                i = 0
+                for armature, bone_names in bones_by_armature.items():
+                    armature_eval = armature.evaluated_get(depsgraph)
+                    pose_bones = armature_eval.pose.bones
+                    matrix_world = armature_eval.matrix_world.copy()
+                    is_identity = matrix_world == IDENTITY_MATRIX
                     
-                    # Convert to pixel coordinates with top-left origin (0,0)
-                    pixel_pos = {
-                        "x": int(cam_pos.x * res_x),
-                        "y": int((1.0 - cam_pos.y) * res_y)
-                    }
-                    
-                    empty_trace.append(pixel_pos)
+                    for bone_name in bone_names:
+                        bone = pose_bones[bone_name]
+                        
+                        # Get bone position based on selected point
+                        if props.bone_point == 'HEAD':
+                            bone_pos = bone.head
+                        elif props.bone_point == 'TAIL':
+                            bone_pos = bone.tail
+                        else:  # CENTER
+                            bone_pos = (bone.head + bone.tail) / 2
+                        
+                        # Convert to world space using this armature's matrix
+                        world_positions[f, i] = bone_pos if is_identity else matrix_world @ bone_pos
+                        i += 1
                 
-                bone_traces.append(empty_trace)
+                # Process empty objects
+                for i, empty in enumerate(selected_empties, start=len(selected_bones_with_armature)):
+                    # Get empty object's world position straight from the matrix, no translation Vector
+                    matrix_world = empty.evaluated_get(depsgraph).matrix_world
+                    world_positions[f, i] = (matrix_world[0][3], matrix_world[1][3], matrix_world[2][3])
             
         finally:
-            # Restore original frame and active object
+            # Restore modifiers and original frame
+            for modifier in muted_modifiers:
+                modifier.show_viewport = True
             context.scene.frame_set(current_frame)
-            context.view_layer.objects.active = original_active
+        
+        # Convert to pixel coordinates with top-left origin (0,0)
+        project_to_pixels(
+            world_positions[:num_sampled_frames],
+            cam_projs[:num_sampled_frames],
+            res_x,
+            res_y,
+            coords[:num_sampled_frames],
+        )
+        coords[num_sampled_frames:] = coords[:1]
+        
+        # One [x, y] list per point, laid out per trace for encoding
+        bone_traces = coords.transpose(1, 0, 2).tolist()
         
         # Save to text file
         output_path = bpy.path.abspath(props.output_path)
         try:
-            with open(output_path, 'w') as f:
-                json.dump(bone_traces, f, indent=2)
+            # Encode up front so the file is written in one call instead of per token
+            payload = encode_traces(bone_traces, props.output_format)
+            with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(payload)
             
             total_objects = len(selected_armatures) + len(selected_empties)
-            self.report({'INFO'}, f"Exported {len(bone_traces)} traces from {total_objects} object(s) ({frame_end - frame_start + 1} frames each) to {output_path}")
+            self.report({'INFO'}, f"Exported {len(bone_traces)} traces from {total_objects} object(s) ({num_frames} frames each) to {output_path}")
             self.report({'INFO'}, "Open the text file and copy the content to use in ComfyUI")
             
         except Exception as e:
@@ -225,9 +495,12 @@ class BONE_TRACER_OT_export(Operator):
         """Group connected bones into chains"""
         chains = []
         processed = set()
+        # Pose bones hash by their underlying pointer, so this also keeps
+        # same-named bones from different armatures apart
+        selected_set = set(selected_bones)
         
         for bone in selected_bones:
-            if bone.name in processed:
+            if bone in processed:
                 continue
                 
             # Start a new chain
@@ -235,18 +508,18 @@ class BONE_TRACER_OT_export(Operator):
             current = bone
             
             # Go to the root of this chain
-            while current.parent and current.parent in selected_bones:
+            while current.parent and current.parent in selected_set:
                 current = current.parent
             
             # Build chain from root to tip
-            while current and current in selected_bones:
+            while current and current in selected_set:
                 chain.append(current)
-                processed.add(current.name)
+                processed.add(current)
                 
                 # Find child in selected bones
                 next_bone = None
                 for child in current.children:
-                    if child in selected_bones:
+                    if child in selected_set:
                         next_bone = child
                         break
                 current = next_bone
@@ -256,6 +529,31 @@ class BONE_TRACER_OT_export(Operator):
         
         return chains
 
+# Selection summary per view layer for the panel, rebuilt after any depsgraph update
+selection_cache = {}
+
+@persistent
+def clear_selection_cache(*args):
+    """Invalidate the cached selection summary when the scene or selection changes"""
+    selection_cache.clear()
+
+def get_selection_summary(context):
+    """Return ([(armature name, selected bone count)], [empty name]) for the current selection"""
+    key = context.view_layer.as_pointer()
+    summary = selection_cache.get(key)
+    
+    if summary is None:
+        armature_bone_counts = []
+        empty_names = []
+        for obj in context.selected_objects:
+            if obj.type == 'ARMATURE':
+                armature_bone_counts.append((obj.name, sum(1 for bone in obj.pose.bones if bone.bone.select)))
+            elif obj.type == 'EMPTY':
+                empty_names.append(obj.name)
+        summary = selection_cache[key] = (armature_bone_counts, empty_names)
+    
+    return summary
+
 class BONE_TRACER_PT_panel(Panel):
     """Creates a Panel in the 3D Viewport N-Panel"""
     bl_label = "Bone Tracer"
@@ -306,30 +604,29 @@ class BONE_TRACER_PT_panel(Panel):
         # Output settings
         layout.separator()
         layout.prop(props, "output_path")
+        layout.prop(props, "output_format")
         
         # Export button
         layout.separator()
         
-        # Selection info
-        selected_armatures = [obj for obj in context.selected_objects if obj.type == 'ARMATURE']
-        selected_empties = [obj for obj in context.selected_objects if obj.type == 'EMPTY']
+        # Selection info, cached since draw runs on every redraw
+        armature_bone_counts, empty_names = get_selection_summary(context)
         total_selected_bones = 0
         
-        if selected_armatures:
-            layout.label(text=f"Selected Armatures: {len(selected_armatures)}")
+        if armature_bone_counts:
+            layout.label(text=f"Selected Armatures: {len(armature_bone_counts)}")
             
-            for armature in selected_armatures:
-                selected_count = sum(1 for bone in armature.pose.bones if bone.bone.select)
+            for armature_name, selected_count in armature_bone_counts:
                 total_selected_bones += selected_count
                 if selected_count > 0:
-                    layout.label(text=f"  {armature.name}: {selected_count} bones")
+                    layout.label(text=f"  {armature_name}: {selected_count} bones")
         
-        if selected_empties:
-            layout.label(text=f"Selected Empty Objects: {len(selected_empties)}")
-            for empty in selected_empties:
-                layout.label(text=f"  {empty.name}")
+        if empty_names:
+            layout.label(text=f"Selected Empty Objects: {len(empty_names)}")
+            for empty_name in empty_names:
+                layout.label(text=f"  {empty_name}")
         
-        total_traces = total_selected_bones + len(selected_empties)
+        total_traces = total_selected_bones + len(empty_names)
         if total_traces > 0:
             layout.label(text=f"Total Traces: {total_traces}")
             
@@ -340,7 +637,7 @@ class BONE_TRACER_PT_panel(Panel):
             total_points = total_traces * frame_count
             layout.label(text=f"Total Points: {total_points}")
         
-        if not selected_armatures and not selected_empties:
+        if not armature_bone_counts and not empty_names:
             layout.label(text="Select Armature and/or Empty Objects", icon='INFO')
         
         # Instructions
@@ -368,8 +665,19 @@ def register():
         bpy.utils.register_class(cls)
     
     bpy.types.Scene.bone_tracer_props = bpy.props.PointerProperty(type=BoneTracerProperties)
+    
+    bpy.app.handlers.depsgraph_update_post.append(clear_selection_cache)
+    bpy.app.handlers.load_post.append(clear_selection_cache)
+    
+    # Pay the Numba compile cost at startup instead of on the first export
+    if project_all is not None:
+        project_all(np.zeros((1, 1, 3)), np.identity(4)[np.newaxis], 1, 1, np.empty((1, 1, 2), dtype=np.int32))
 
 def unregister():
+    bpy.app.handlers.load_post.remove(clear_selection_cache)
+    bpy.app.handlers.depsgraph_update_post.remove(clear_selection_cache)
+    selection_cache.clear()
+    
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
     